@@ -3,19 +3,37 @@ This script creates a stock management application using Streamlit.
 """
 
 # Import the libraries
+import numpy as np
 import os
+import time
 import pandas as pd
+import pyarrow as pa
+import shutil
 import streamlit as st
 
-from io import StringIO
+from io import BytesIO
+from pyarrow import csv as pacsv
+from pyarrow import parquet as pq
 from typing import Tuple
 
 # ==================================================
 # Define the constants
 
 
-DB_FILENAME = "db.csv"
+DB_DIRNAME = "db.parquet"
+DB_CSV_FILENAME = "db.csv"
+DB_MAX_PARTS = 16
 DB_COLS = ["code_article", "designation", "dlc", "quantite"]
+DB_SCHEMA = pa.schema(
+    [
+        ("code_article", pa.string()),
+        ("designation", pa.string()),
+        ("dlc", pa.timestamp("ns")),
+        ("quantite", pa.int32()),
+    ]
+)
+DB_PART_SCHEMA = DB_SCHEMA.append(pa.field("row_id", pa.int64()))
+CSV_OPTIONS = pacsv.ConvertOptions(column_types=DB_SCHEMA, strings_can_be_null=True)
 
 
 # ==================================================
@@ -42,37 +60,145 @@ def check_db(db: pd.DataFrame):
     return ""
 
 
-def load_db(filename: str) -> Tuple[pd.DataFrame, str]:
+@st.cache_data(show_spinner=False)
+def read_db(dirname: str, mtime: float) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Load the database from the specified file.
+    Read the database from the specified directory. The result is cached until the directory
+    changes.
 
     Parameters
     ----------
-    filename : str
-        The name of the file to load the database from.
+    dirname : str
+        The name of the directory containing the Parquet parts of the database.
+
+    mtime : float
+        The last modification time of the directory, used as part of the cache key.
 
     Returns
     -------
-    Tuple[pd.DataFrame, str]
-        A tuple containing the loaded database and an error message if an error occurred.
+    Tuple[pd.DataFrame, pd.DataFrame]
+        A tuple containing the database read from the directory, sorted on 'dlc' and indexed by
+        the row ids, and its lowercased search keys.
+    """
+    # Read the parts in the order they were written, and keep only the latest version of each
+    # row since the edits are written as new parts
+    parts = [os.path.join(dirname, part) for part in sorted(os.listdir(dirname))]
+    table = pq.read_table(parts, schema=DB_PART_SCHEMA)
+    rows = table.append_column("row", pa.array(np.arange(table.num_rows)))
+    latest = rows.group_by("row_id").aggregate([("row", "max")])["row_max"]
+
+    # Sort the rows on 'dlc', so that searches can slice a date range with a binary search. The
+    # 'dlc' column is kept as a NumPy datetime64 array, which pandas can search without a copy.
+    table = table.take(latest).sort_by("dlc")
+    types = {pa.string(): pd.ArrowDtype(pa.string()), pa.int32(): pd.ArrowDtype(pa.int32())}
+    db = table.drop_columns(["row_id"]).to_pandas(types_mapper=types.get)
+    db.index = pd.Index(table["row_id"].to_numpy(), name="row_id")
+
+    # Lowercase the searchable columns once, instead of on every search. The designations repeat,
+    # so they are stored as categories and a search only scans the distinct designations.
+    keys = pd.DataFrame(
+        {
+            "code_article": db["code_article"].str.lower(),
+            "designation": db["designation"].str.lower().astype("category"),
+        }
+    )
+
+    return db, keys
+
+
+def write_part(data: pd.DataFrame | pa.Table, row_ids: np.ndarray, dirname: str) -> None:
     """
-    # If the file exists, load the database from it
-    if os.path.exists(filename):
-        db = pd.read_csv(filename)
+    Write the data as a new Parquet part of the database, leaving the existing parts untouched. The
+    rows of the new part replace the rows with the same ids in the older parts.
 
-    # If the file doesn't exist, create an empty database
-    else:
-        db = pd.DataFrame(columns=DB_COLS)
-        db.to_csv(filename, index=False)
+    Parameters
+    ----------
+    data : pd.DataFrame | pa.Table
+        The rows to write.
+
+    row_ids : np.ndarray
+        The ids of the rows to write, new ids for new rows.
+
+    dirname : str
+        The name of the directory containing the Parquet parts of the database.
+    """
+    if isinstance(data, pd.DataFrame):
+        data = pa.Table.from_pandas(data, schema=DB_SCHEMA, preserve_index=False)
 
-    # Convert the columns to the correct data types
-    db = db.astype({"code_article": str, "designation": str, "quantite": int})
-    db["dlc"] = pd.to_datetime(db["dlc"])
+    data = data.append_column("row_id", pa.array(row_ids, type=pa.int64()))
 
-    return db, check_db(db)
+    # Only the designations repeat, the article codes are unique so a dictionary would not help
+    filename = os.path.join(dirname, f"part-{time.time_ns()}.parquet")
+    pq.write_table(data, filename, compression="zstd", use_dictionary=["designation"])
+    read_db.clear()
 
 
-def search_product(db: pd.DataFrame, item_code: str, item_name: str, expiry_date: pd.Timestamp) -> pd.DataFrame:
+def save_db(db: pd.DataFrame, dirname: str) -> None:
+    """
+    Save the whole database as a single Parquet part, replacing the existing parts.
+
+    Parameters
+    ----------
+    db : pd.DataFrame
+        The database to save.
+
+    dirname : str
+        The name of the directory containing the Parquet parts of the database.
+    """
+    old_parts = os.listdir(dirname)
+    write_part(db, db.index.to_numpy(), dirname)
+
+    for part in old_parts:
+        os.remove(os.path.join(dirname, part))
+
+
+def load_db(dirname: str) -> Tuple[pd.DataFrame, pd.DataFrame, str]:
+    """
+    Load the database from the specified directory.
+
+    Parameters
+    ----------
+    dirname : str
+        The name of the directory containing the Parquet parts of the database.
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame, str]
+        A tuple containing the loaded database, its lowercased search keys, and an error message if
+        an error occurred.
+    """
+    # If the directory doesn't exist, create it and import the CSV database if there is one. The
+    # import is written to a temporary directory first, so that a failed import leaves nothing
+    # behind and is attempted again on the next run.
+    if not os.path.exists(dirname):
+        tmp_dirname = f"{dirname}.tmp"
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
+        os.makedirs(tmp_dirname)
+
+        try:
+            if os.path.exists(DB_CSV_FILENAME):
+                table = pacsv.read_csv(DB_CSV_FILENAME, convert_options=CSV_OPTIONS)
+                write_part(table, np.arange(table.num_rows), tmp_dirname)
+
+        except Exception:
+            shutil.rmtree(tmp_dirname)
+            return None, None, f"Erreur: Impossible d'importer le fichier '{DB_CSV_FILENAME}'."
+
+        os.replace(tmp_dirname, dirname)
+
+    db, keys = read_db(dirname, os.path.getmtime(dirname))
+
+    # Merge the parts back into a single one once the edits have piled up
+    if len(os.listdir(dirname)) > DB_MAX_PARTS:
+        save_db(db, dirname)
+        db, keys = read_db(dirname, os.path.getmtime(dirname))
+
+    return db, keys, check_db(db)
+
+
+def search_product(
+    db: pd.DataFrame, keys: pd.DataFrame, item_code: str, item_name: str, expiry_date: pd.Timestamp
+) -> pd.DataFrame:
     """
     Search for products in the database based on the specified criteria.
 
@@ -81,6 +207,9 @@ def search_product(db: pd.DataFrame, item_code: str, item_name: str, expiry_date
     db : pd.DataFrame
         The database to search in.
 
+    keys : pd.DataFrame
+        The lowercased 'code_article' and 'designation' columns of the database.
+
     code_article : str
         The code of the article to search for.
 
@@ -95,41 +224,70 @@ def search_product(db: pd.DataFrame, item_code: str, item_name: str, expiry_date
     pd.DataFrame
         The filtered database containing the products that match the search criteria
     """
-    filtered_db = db.copy()
+    # Filtering based on the 'dlc', from the expiration date to the end of its month. The database
+    # is sorted on 'dlc', so the matching rows are a contiguous slice found by binary search.
+    expiry_date = pd.Timestamp(expiry_date)
+    start = db["dlc"].searchsorted(expiry_date, side="left")
+    end = db["dlc"].searchsorted(get_month_end(expiry_date), side="right")
+    filtered_db, keys = db.iloc[start:end], keys.iloc[start:end]
 
-    # Filtering based on the 'code_article'
-    filter_code = filtered_db["code_article"].str.lower().str.contains(item_code.lower())
-    filtered_db = filtered_db[filter_code]
+    # Without any text filter, the slice is already the result
+    if not item_code and not item_name:
+        return filtered_db
 
-    # Filtering based on the 'designation'
-    filter_name = filtered_db["designation"].str.lower().str.contains(item_name.lower())
-    filtered_db = filtered_db[filter_name]
+    mask = np.ones(end - start, dtype=bool)
 
-    # Filtering based on the 'dlc'
-    data_date = filtered_db["dlc"].dt
-    filter_dlc_day = data_date.day >= expiry_date.day
-    filter_dlc_date = (data_date.month == expiry_date.month) & (data_date.year == expiry_date.year)
-    filtered_db = filtered_db[filter_dlc_day & filter_dlc_date]
+    # Filtering based on the 'code_article', skipped if no code is specified
+    if item_code:
+        filter_code = keys["code_article"].str.contains(item_code.lower(), regex=False, na=False)
+        mask &= filter_code.to_numpy(dtype=bool)
 
-    # Sort the filtered database based on the 'dlc' column
-    filtered_db = filtered_db.sort_values("dlc")
+    # Filtering based on the 'designation', skipped if no designation is specified
+    if item_name:
+        filter_name = keys["designation"].str.contains(item_name.lower(), regex=False, na=False)
+        mask &= filter_name.to_numpy(dtype=bool)
 
-    return filtered_db
+    # Apply the text filters at once, the slice is already sorted on 'dlc'
+    return filtered_db.loc[mask]
 
 
-def get_month_start() -> pd.Timestamp:
+def get_month_start(date: pd.Timestamp) -> pd.Timestamp:
     """
-    Get the first day of the current month.
+    Get the first day of the month of the specified date.
+
+    Parameters
+    ----------
+    date : pd.Timestamp
+        The date to get the first day of the month for.
 
     Returns
     -------
     pd.Timestamp
-        The first day of the current month.
+        The first day of the month.
     """
-    return pd.Timestamp.today().replace(day=1)
+    return date.replace(day=1)
+
+
+def get_month_end(date: pd.Timestamp) -> pd.Timestamp:
+    """
+    Get the end of the month of the specified date.
+
+    Parameters
+    ----------
+    date : pd.Timestamp
+        The date to get the end of the month for.
+
+    Returns
+    -------
+    pd.Timestamp
+        The last instant of the last day of the month.
+    """
+    month = np.datetime64(date, "M")
+
+    return pd.Timestamp(month + np.timedelta64(1, "M") - np.timedelta64(1, "ns"))
 
 
-def update_db(db: pd.DataFrame, new_data: pd.DataFrame, filename: str) -> Tuple[pd.DataFrame, str]:
+def update_db(db: pd.DataFrame, new_data: pd.DataFrame, dirname: str) -> Tuple[pd.DataFrame, str]:
     """
     Update the database with the new data.
 
@@ -141,8 +299,8 @@ def update_db(db: pd.DataFrame, new_data: pd.DataFrame, filename: str) -> Tuple[
     new_data : pd.DataFrame
         The new data to update the database with.
 
-    filename : str
-        The name of the file to save the updated database to.
+    dirname : str
+        The name of the directory to save the updated database to.
 
     Returns
     -------
@@ -156,48 +314,60 @@ def update_db(db: pd.DataFrame, new_data: pd.DataFrame, filename: str) -> Tuple[
 
     # Update the database with the new data
     else:
-        db = db.copy()
+        new_data = new_data[new_data.index.isin(db.index)]
+        old_data = db.loc[new_data.index, new_data.columns]
         db.update(new_data)
-        db.to_csv(filename, index=False)
+
+        # Write only the rows that changed as a new part, instead of rewriting the whole database
+        changed = np.logical_or.reduce(
+            [new_data[c].ne(old_data[c]).to_numpy(bool, na_value=True) for c in DB_COLS]
+        )
+
+        if changed.any():
+            row_ids = new_data.index[changed]
+            write_part(db.loc[row_ids], row_ids.to_numpy(), dirname)
 
         return db, error_message
 
 
-def add_articles(db: str, articles: str, filename: str) -> Tuple[pd.DataFrame, pd.DataFrame, str]:
+def add_articles(db: pd.DataFrame, articles: str, dirname: str) -> Tuple[pd.DataFrame, str]:
     """
     Add new articles to the database.
 
     Parameters
     ----------
     db : pd.DataFrame
-        The current database.
+        The current database, used to give new ids to the new articles.
 
     new_articles : str
         The text containing the new articles to add.
 
-    filename : str
-        The name of the file to save the updated database to.
+    dirname : str
+        The name of the directory to save the new articles to.
 
     Returns
     -------
-    Tuple[pd.DataFrame, pd.DataFrame, str]
-        A tuple containing the updated database, the new data added, and an error message if an
-        error occurred.
+    Tuple[pd.DataFrame, str]
+        A tuple containing the new data added and an error message if an error occurred. The
+        database itself is reloaded on the next rerun.
     """
     if not articles.strip():
         return None, "Veuillez saisir au moins un article à ajouter."
 
     try:
-        # Use StringIO to read the text as if it were a CSV file
-        new_data = pd.read_csv(StringIO(articles), header=None, names=DB_COLS, dtype=str)
-        new_data["dlc"] = pd.to_datetime(new_data["dlc"])
+        # Use BytesIO to read the text as if it were a CSV file
+        read_options = pacsv.ReadOptions(column_names=DB_COLS)
+        table = pacsv.read_csv(
+            BytesIO(articles.encode()), read_options=read_options, convert_options=CSV_OPTIONS
+        )
+        new_data = table.to_pandas(types_mapper=pd.ArrowDtype)
 
-        # Append the new data to the existing DataFrame
-        db = pd.concat([db, new_data], ignore_index=True)
+        # Write only the new rows as a new part instead of rewriting the whole database, with ids
+        # following the existing ones so that they are appended
+        start = db.index.max() + 1 if len(db) else 0
+        write_part(table, np.arange(start, start + table.num_rows), dirname)
 
-        # Save the updated DataFrame to the CSV file
-        db.to_csv(filename, index=False)
-        return db, new_data, None
+        return new_data, None
 
     except Exception:
         error_message = """
@@ -214,42 +384,48 @@ def add_articles(db: str, articles: str, filename: str) -> Tuple[pd.DataFrame, p
             - 003,Article 3,2023-02-28,30
 
         """
-        return None, None, error_message
+        return None, error_message
 
 
 # ==================================================
 
 
 if __name__ == "__main__":
-    # Load the database from the specified file
-    db, error_message = load_db(DB_FILENAME)
+    # Set up the application parameters
+    st.set_page_config(layout="wide", page_title="Stock Management", page_icon="📦")
+    st.title("Gestion de stock")
+
+    # Load the database from the specified directory
+    db, keys, error_message = load_db(DB_DIRNAME)
 
     if error_message:
         st.error(error_message)
         st.stop()
 
-    # Set up the application parameters
-    st.set_page_config(layout="wide", page_title="Stock Management", page_icon="📦")
-    st.title("Gestion de stock")
-
     # Define the tabs for the application
     tabs_list = ["Rechercher des articles", "Ajouter des articles"]
     tab_search, tab_add = st.tabs(tabs_list)
 
     # Manage the tab for searching articles in the database and editing them
     with tab_search:
-        # Create columns for filter input
-        column_code, column_name, column_date = st.columns(3)
-
-        # Input fields for filtering articles
-        filter_code = column_code.text_input("Code d'article", placeholder="001")
-        filter_name = column_name.text_input("Designation", placeholder="...")
-        filter_date = column_date.date_input(
-            "Date limite de consommation", value=get_month_start(), format="YYYY-MM-DD"
-        )
+        # Group the filter inputs in a form, so that they are only applied when it is submitted
+        with st.form("search_form"):
+            # Create columns for filter input
+            column_code, column_name, column_date = st.columns(3)
+
+            # Input fields for filtering articles
+            filter_code = column_code.text_input("Code d'article", placeholder="001")
+            filter_name = column_name.text_input("Designation", placeholder="...")
+            filter_date = column_date.date_input(
+                "Date limite de consommation",
+                value=get_month_start(pd.Timestamp.today()),
+                format="YYYY-MM-DD",
+            )
+
+            st.form_submit_button("Rechercher")
 
         # Filter the database based on input criteria
-        db_filtered = search_product(db, filter_code, filter_name, filter_date)
+        db_filtered = search_product(db, keys, filter_code, filter_name, filter_date)
 
         # Toggle to allow editing of the table
         _, _, column_edit = st.columns(3)
@@ -272,9 +448,13 @@ if __name__ == "__main__":
             disabled={"code_article": True},
         )
 
+        # Compare only the editable columns once, the article codes cannot be edited
+        editable_cols = ["designation", "dlc", "quantite"]
+        unchanged = db_edited[editable_cols].equals(db_filtered[editable_cols])
+
         # Button to save changes if any modifications are made
-        if st.button("Sauvegarder les modifications", disabled=not toggle_edit):
-            db, error_message = update_db(db, db_edited, DB_FILENAME)
+        if st.button("Sauvegarder les modifications", disabled=not toggle_edit or unchanged):
+            db, error_message = update_db(db, db_edited, DB_DIRNAME)
 
             # Display feedback to the user
             if error_message:
@@ -294,7 +474,7 @@ if __name__ == "__main__":
 
         if st.button("Enregistrer les articles"):
             # Call the function to add articles
-            db, new_data, error_message = add_articles(db, text, DB_FILENAME)
+            new_data, error_message = add_articles(db, text, DB_DIRNAME)
 
             # Display feedback to the user
             if error_message:
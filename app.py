@@ -3,11 +3,18 @@ This script creates a stock management application using Streamlit and MongoDB.
 """
 
 # Import the libraries
+import numpy as np
 import pandas as pd
 import streamlit as st
 import textwrap
 
-from functions.mongo_api import add_products, connect_db, search_products, update_products
+from functions.mongo_api import (
+    add_products,
+    connect_db,
+    create_indexes,
+    search_products,
+    update_products,
+)
 from functions.utils import get_month_start, send_email
 from functions.constants import DB_SCHEMA, DATE_FORMAT, DATE_FORMAT_PD
 
@@ -22,6 +29,12 @@ def init_state() -> None:
     if "products" not in st.session_state:
         st.session_state["products"] = pd.DataFrame(columns=DB_SCHEMA.keys())
 
+    if "search_key" not in st.session_state:
+        st.session_state["search_key"] = None
+
+    if "indexed_collection" not in st.session_state:
+        st.session_state["indexed_collection"] = None
+
     if "toggle_edit" not in st.session_state:
         st.session_state["toggle_edit"] = False
 
@@ -39,9 +52,12 @@ def on_change_toggle_edit() -> None:
 if __name__ == "__main__":
 
     # Set up the application parameters
-    init_state()
     st.set_page_config(layout="wide", page_title="Stock Management", page_icon="📦")
     st.title("Gestion de stock")
+    init_state()
+
+    # Get the current date once for the whole run
+    today = pd.Timestamp.today()
 
     # Input field to select the environment
     _, _, column_env = st.columns(3)
@@ -56,33 +72,60 @@ if __name__ == "__main__":
         st.error(error_message)
         st.stop()
 
+    # Create the indexes of the collection once per session, the application still works without
+    # them so a failure is only shown as a warning
+    if st.session_state["indexed_collection"] != collection_name:
+        error_message = create_indexes(collection)
+
+        if error_message:
+            st.warning(error_message)
+
+        st.session_state["indexed_collection"] = collection_name
+
     # Define the tabs for the application
     tabs_list = ["Rechercher des articles", "Ajouter des articles"]
     tab_search, tab_add = st.tabs(tabs_list)
 
     # Manage the tab for searching articles in the database and editing them
     with tab_search:
-        # Create columns for filter input
-        column_code, column_name, column_date = st.columns(3)
-
-        # Input fields for filtering articles
-        filter_code = column_code.text_input("Code d'article", placeholder="001")
-        filter_name = column_name.text_input("Designation", placeholder="Article")
-        filter_date = column_date.text_input(
-            "Date limite de consommation",
-            value=get_month_start().date().strftime(DATE_FORMAT_PD),
-            placeholder=DATE_FORMAT,
-            max_chars=10,
-            help="JJ/MM/AAAA (ex: 31/12/2024)",
-        )
+        # Group the filter inputs in a form, so that they are only applied when it is submitted
+        with st.form("search_form"):
+            # Create columns for filter input
+            column_code, column_name, column_date = st.columns(3)
+
+            # Input fields for filtering articles
+            filter_code = column_code.text_input("Code d'article", placeholder="001")
+            filter_name = column_name.text_input("Designation", placeholder="Article")
+            filter_date = column_date.text_input(
+                "Date limite de consommation",
+                value=get_month_start(today).strftime(DATE_FORMAT_PD),
+                placeholder=DATE_FORMAT,
+                max_chars=10,
+                help="JJ/MM/AAAA (ex: 31/12/2024)",
+            )
+
+            # Button to search for articles
+            submitted = st.form_submit_button("Rechercher")
 
         # Create columns for action inputs
-        column_edit, _, column_search = st.columns(3)
+        column_edit, _, _ = st.columns(3)
 
-        # Button to search for articles
-        st.session_state["products"] = search_products(
-            collection, filter_code, filter_name, filter_date
-        )
+        # Query the database only on submit or when the collection or the filters changed,
+        # otherwise reuse the products of the previous run
+        search_key = (collection_name, filter_code, filter_name, filter_date)
+
+        if submitted or st.session_state["search_key"] != search_key:
+            products, error_message = search_products(
+                collection, filter_code, filter_name, filter_date
+            )
+            st.session_state["products"] = products
+
+            # Keep the search key unset on error, so that the search is retried on the next run
+            if error_message:
+                st.error(error_message)
+
+            else:
+                st.session_state["search_key"] = search_key
 
         # Toggle to allow editing of the table
         toggle_edit = column_edit.checkbox(
@@ -119,11 +162,13 @@ if __name__ == "__main__":
             # Get the deleted rows
             deleted_rows = db_filtered[~db_filtered["code"].isin(db_edited["code"])]
 
-            # Get the modified rows
-            common_ids = db_filtered["code"].isin(db_edited["code"])
-            A_common = db_filtered[common_ids].set_index("code")
-            B_common = db_edited.set_index("code")
-            modified_rows = B_common[~B_common.eq(A_common).all(axis=1)].reset_index()
+            # Get the modified rows by joining the original and edited rows on their code
+            diff = db_filtered.merge(db_edited, on="code", suffixes=("_a", "_b"))
+            columns = [column for column in DB_SCHEMA.keys() if column != "code"]
+            changed = np.logical_or.reduce(
+                [diff[f"{c}_a"].ne(diff[f"{c}_b"]).to_numpy(bool, na_value=True) for c in columns]
+            )
+            modified_rows = db_edited[db_edited["code"].isin(diff.loc[changed, "code"])]
 
             # Update the database with the modified data
             error_message = update_products(collection, modified_rows, deleted_rows)
@@ -134,6 +179,7 @@ if __name__ == "__main__":
 
             else:
                 st.session_state["toggle_edit"] = False
+                st.session_state["search_key"] = None
                 st.rerun()
 
         # Button to send the table by email
@@ -172,6 +218,9 @@ if __name__ == "__main__":
             # Call the function to add articles
             new_data, error_message = add_products(collection, text)
 
+            # Refresh the search on the next run, some articles may have been added even on error
+            st.session_state["search_key"] = None
+
             # Display feedback to the user
             if error_message:
                 st.error(error_message)
@@ -2,14 +2,34 @@
 This module contains constants used in the application.
 """
 
+# Import libraries
+import pyarrow as pa
+
 # The database schema
 DB_SCHEMA = {
-    "code": (object, "chaîne de caractères"),
-    "designation": (object, "chaîne de caractères"),
+    "code": ("string[pyarrow]", "chaîne de caractères"),
+    "designation": ("string[pyarrow]", "chaîne de caractères"),
     "dlc": ("datetime64[ns]", "date"),
-    "quantite": (int, "entier"),
+    "quantite": ("int32", "entier"),
 }
 
+# The columns of the database, in the order of the schema
+DB_COLUMNS = tuple(DB_SCHEMA.keys())
+
+# The schema used to parse CSV input with pyarrow. The dates are read as strings and parsed by
+# pandas, since pyarrow silently normalizes dates that do not exist (e.g. 31/02).
+DB_CSV_SCHEMA = pa.schema(
+    [
+        ("code", pa.string()),
+        ("designation", pa.string()),
+        ("dlc", pa.string()),
+        ("quantite", pa.int32()),
+    ]
+)
+
+# Case-insensitive collation used to search the article codes by prefix
+CODE_COLLATION = {"locale": "en", "strength": 2}
+
 # Format for the date
 DATE_FORMAT = "DD/MM/YYYY"
 
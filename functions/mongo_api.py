@@ -4,13 +4,25 @@ This module contains functions to interact with a MongoDB database.
 
 # Import libraries
 import pandas as pd
+import pyarrow as pa
 import pymongo
+import re
 import streamlit as st
 
-from io import StringIO
+from datetime import datetime
+from io import BytesIO
+from pyarrow import csv as pacsv
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 
-from functions.utils import get_month_end, is_valid_data, is_valid_date, typecast_data
-from functions.constants import DB_SCHEMA, DATE_FORMAT, DATE_FORMAT_PD
+from functions.utils import get_month_end, is_valid_data, is_valid_date
+from functions.constants import (
+    CODE_COLLATION,
+    DB_CSV_SCHEMA,
+    DB_SCHEMA,
+    DATE_FORMAT,
+    DATE_FORMAT_PD,
+)
 
 
 @st.cache_resource
@@ -48,12 +60,81 @@ def connect_db(
         return None, None, None, "Erreur: Impossible de se connecter à la base de données."
 
 
+@st.cache_resource(show_spinner=False)
+def _create_indexes(_collection: pymongo.collection.Collection, full_name: str) -> str:
+    """
+    Create the indexes used by the search and update queries (no-op if they exist). Each index is
+    created on its own, so that one failure does not prevent the others from being created. The
+    result is cached per collection, even on failure.
+
+    Parameters
+    ----------
+    _collection : pymongo.collection.Collection
+        The collection to create the indexes on.
+
+    full_name : str
+        The full name of the collection, used as the cache key.
+
+    Returns
+    -------
+    str
+        An error message listing the indexes that could not be created.
+    """
+    indexes = [
+        (
+            "dlc_1_code_1_designation_1",
+            [
+                ("dlc", pymongo.ASCENDING),
+                ("code", pymongo.ASCENDING),
+                ("designation", pymongo.ASCENDING),
+            ],
+            {},
+        ),
+        ("code_1", "code", {"unique": True}),
+        ("code_ci", "code", {"collation": CODE_COLLATION}),
+    ]
+    failed = []
+
+    for name, keys, options in indexes:
+        try:
+            _collection.create_index(keys, name=name, **options)
+
+        except Exception:
+            failed.append(name)
+
+    if failed:
+        return (
+            "Attention: La recherche peut être plus lente, les index suivants n'ont pas pu être "
+            f"créés: {', '.join(failed)}."
+        )
+
+    return ""
+
+
+def create_indexes(collection: pymongo.collection.Collection) -> str:
+    """
+    Create the indexes of the collection, once per collection and process. A failure does not
+    affect the cached connection.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        The collection to create the indexes on.
+
+    Returns
+    -------
+    str
+        An error message if an error occurred.
+    """
+    return _create_indexes(collection, collection.full_name)
+
+
 def search_products(
     collection: pymongo.collection.Collection,
     filter_code: str,
     filter_name: str,
     filter_dlc: str,
-) -> pd.DataFrame:
+) -> tuple[pd.DataFrame, str]:
     """
     Search for products in the database based on the specified criteria.
 
@@ -63,7 +144,7 @@ def search_products(
         The collection to search in.
 
     filter_code : str
-        The code of the article to search for.
+        The beginning of the code of the article to search for.
 
     filter_name : str
         The designation of the article to search for.
@@ -73,41 +154,68 @@ def search_products(
 
     Returns
     -------
-    pd.DataFrame
-        The filtered database containing the products that match the search criteria
+    Tuple[pd.DataFrame, str]
+        A tuple containing the filtered database with the products that match the search criteria,
+        empty if an error occurred, and an error message if an error occurred.
     """
-    # Create the filter dictionary
-    filter_dict = {
-        "code": {"$regex": filter_code, "$options": "i"},
-        "designation": {"$regex": filter_name, "$options": "i"},
-    }
+    # Create the filter dictionary, leaving out the empty filters. The code is matched by prefix
+    # as a range, which the case-insensitive index on 'code' can serve under the query collation
+    # (U+FFFF sorts after every character). The designation is matched as a case-insensitive
+    # literal substring.
+    filter_dict = {}
+
+    if filter_code:
+        filter_dict["code"] = {"$gte": filter_code, "$lt": filter_code + "\uffff"}
+
+    if filter_name:
+        filter_dict["designation"] = {"$regex": re.escape(filter_name), "$options": "i"}
 
     # Add the expiration date filter if specified
     if filter_dlc and is_valid_date(filter_dlc):
-        filter_dlc = pd.to_datetime(filter_dlc, format=DATE_FORMAT_PD)
+        filter_dlc = pd.Timestamp(datetime.strptime(filter_dlc, DATE_FORMAT_PD))
 
         filter_dict["dlc"] = {
             "$gte": filter_dlc,
             "$lte": get_month_end(filter_dlc),
         }
 
-    # Perform the search query
+    # Perform the search query, sorted on the 'dlc' index by the server. Disk use is disallowed so
+    # that a sort which cannot use the index fails instead of silently spilling to disk. The
+    # case-insensitive collation is only used for a code prefix, the other indexes use the simple
+    # collation and could not serve the query under another one.
     projection = {"_id": 0, "code": 1, "designation": 1, "dlc": 1, "quantite": 1}
-    documents = collection.find(filter_dict, projection)
-    filtered_db = pd.DataFrame(list(documents), dtype=str)
+    collation = CODE_COLLATION if filter_code else None
+    documents = collection.find(filter_dict, projection, collation=collation, allow_disk_use=False)
+    documents = documents.sort("dlc", pymongo.ASCENDING)
+    documents = documents.batch_size(1000)
+
+    # Collect each field in its own column in a single pass, while the cursor fetches the batches
+    columns = {k: [] for k in DB_SCHEMA.keys()}
+    error_message = ""
+
+    try:
+        for document in documents:
+            for k, values in columns.items():
+                values.append(document.get(k))
 
-    # Convert 'dlc' column to datetime
-    if not filtered_db.empty:
-        filtered_db["dlc"] = pd.to_datetime(filtered_db["dlc"])
-        filtered_db["quantite"] = filtered_db["quantite"].astype(int)
+    # The query fails if the server would have to sort the results in memory beyond its limit
+    except OperationFailure:
+        columns = {k: [] for k in DB_SCHEMA.keys()}
+        error_message = "Erreur: La recherche a échoué, veuillez préciser les filtres."
 
-        # Sort the filtered database based on the 'dlc' column
-        filtered_db = filtered_db.sort_values("dlc")
+    # Build the filtered database with the expected types. A missing field becomes NA, the integer
+    # columns then use the nullable integer type and are rejected by the validation on save.
+    arrays = {}
 
-    else:
-        filtered_db = pd.DataFrame(columns=DB_SCHEMA.keys())
+    for k, (t, _) in DB_SCHEMA.items():
+        if t == "int32" and None in columns[k]:
+            t = "Int32"
 
-    return filtered_db
+        arrays[k] = pd.array(columns[k], dtype=t)
+
+    filtered_db = pd.DataFrame(arrays)
+
+    return filtered_db, error_message
 
 
 def add_products(
@@ -133,20 +241,61 @@ def add_products(
         return None, "Veuillez saisir au moins un article à ajouter."
 
     try:
-        # Convert the text to a DataFrame
-        new_articles = pd.read_csv(StringIO(articles), header=None, names=DB_SCHEMA, dtype=str)
-        new_articles = typecast_data(new_articles)
+        # Convert the text to a DataFrame, pyarrow types the columns while parsing
+        read_options = pacsv.ReadOptions(column_names=list(DB_SCHEMA.keys()))
+        convert_options = pacsv.ConvertOptions(column_types=DB_CSV_SCHEMA, strings_can_be_null=True)
+        table = pacsv.read_csv(
+            BytesIO(articles.encode()), read_options=read_options, convert_options=convert_options
+        )
+        new_articles = table.to_pandas(types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get)
+
+        # Parse the dates with pandas, which rejects dates that do not exist
+        new_articles["dlc"] = pd.to_datetime(new_articles["dlc"], format=DATE_FORMAT_PD)
 
         # Check if the data is valid
         error_message = is_valid_data(new_articles)
         if error_message:
             raise Exception(error_message)
 
-        # Insert the new data into the database
-        collection.insert_many(new_articles.to_dict(orient="records"))
+        # Check that the article codes are not already in the database
+        codes = new_articles["code"].tolist()
+        existing = collection.find({"code": {"$in": codes}}, {"_id": 0, "code": 1})
+        existing_codes = [document["code"] for document in existing]
+
+        if existing_codes:
+            return None, (
+                "Erreur: Les codes d'articles suivants existent déjà: "
+                f"{', '.join(existing_codes)}. Aucun article n'a été ajouté."
+            )
+
+        # Insert the new data into the database, streaming the documents built from plain tuples
+        # instead of materializing them in a list first
+        columns = new_articles.columns.tolist()
+        rows = new_articles.itertuples(index=False, name=None)
+        documents = (dict(zip(columns, row)) for row in rows)
+        collection.insert_many(documents, ordered=False)
 
         return new_articles, ""
 
+    except BulkWriteError as error:
+        # Some articles were rejected by the server, the other articles have been inserted
+        inserted = error.details["nInserted"]
+        write_errors = error.details["writeErrors"]
+
+        # Report the rejected codes if they were all added concurrently (duplicate key errors)
+        rejected = [e["op"]["code"] for e in write_errors if e["code"] == 11000]
+
+        if len(rejected) == len(write_errors):
+            return None, (
+                f"Erreur: {inserted} article(s) ajouté(s), "
+                f"les codes suivants existent déjà: {', '.join(rejected)}."
+            )
+
+        return None, (
+            f"Erreur: {inserted} article(s) ajouté(s), "
+            "impossible d'ajouter les autres articles à la base de données."
+        )
+
     except Exception:
         error_message = f"""
         Les données saisies ne sont pas valides. Veuillez vérifier les points suivants:
@@ -204,13 +353,12 @@ def update_products(
         # Convert the modified data to a dictionary
         modified_dict = modified_rows.to_dict(orient="records")
 
-        # Update the database with the modified data
-        for row in modified_dict:
-            collection.update_one({"code": row["code"]}, {"$set": row})
+        # Update the modified rows and delete the removed ones in a single round-trip
+        operations = [UpdateOne({"code": row["code"]}, {"$set": row}) for row in modified_dict]
+        operations += [DeleteOne({"code": code}) for code in deleted_rows["code"]]
 
-        # Delete the rows that were removed
-        for code in deleted_rows["code"]:
-            collection.delete_one({"code": code})
+        if operations:
+            collection.bulk_write(operations, ordered=False)
 
         return ""
 
@@ -3,55 +3,59 @@ This module contains utility functions for the application.
 """
 
 # Import libraries
+import html
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import smtplib
 
+from datetime import datetime
+from io import BytesIO
+from pyarrow import csv as pacsv
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-from functions.constants import DB_SCHEMA, DATE_FORMAT_PD
+from functions.constants import DB_COLUMNS, DB_SCHEMA, DATE_FORMAT_PD
 
 
-def get_month_start(dlc: None | pd.Timestamp = None) -> pd.Timestamp:
+def get_month_start(dlc: pd.Timestamp) -> pd.Timestamp:
     """
-    Get the first day of the current month.
+    Get the first day of the month of the specified date.
 
     Parameters
     ----------
     dlc : pd.Timestamp
-        The date to get the first day of the month for. Default is the current date
+        The date to get the first day of the month for.
 
     Returns
     -------
     pd.Timestamp
-        The first day of the current month.
+        The first day of the month.
     """
-    if dlc is None:
-        dlc = pd.Timestamp.today()
-
     return dlc.replace(day=1)
 
 
-def get_month_end(dlc: None | pd.Timestamp = None) -> pd.Timestamp:
+def get_month_end(dlc: pd.Timestamp) -> pd.Timestamp:
     """
-    Get the last day of the current month.
+    Get the end of the month of the specified date.
 
     Parameters
     ----------
     dlc : pd.Timestamp
-        The date to get the last day of the month for. Default is the current date
+        The date to get the end of the month for.
 
     Returns
     -------
     pd.Timestamp
-        The last day of the current month.
+        The last instant of the last day of the month.
     """
-    if dlc is None:
-        dlc = pd.Timestamp.today()
+    # Truncate the date to its month with NumPy, then step back from the start of the next month
+    month = np.datetime64(dlc, "M")
 
-    return dlc + pd.offsets.MonthEnd(1)
+    return pd.Timestamp(month + np.timedelta64(1, "M") - np.timedelta64(1, "ns"))
 
 
 def is_valid_data(df_data: pd.DataFrame) -> str:
@@ -61,9 +65,9 @@ def is_valid_data(df_data: pd.DataFrame) -> str:
     The data must meet the following criteria:
         - The data must have the following columns: code, designation, dlc, quantite.
         - The data types must match the expected types.
+        - The data must not contain missing values.
         - The quantities must be positive.
         - The article codes must be unique.
-        - The data must not contain missing values.
 
     Parameters
     ----------
@@ -75,8 +79,8 @@ def is_valid_data(df_data: pd.DataFrame) -> str:
     str
         An error message if the data is not valid.
     """
-    # Check for valid columns
-    if set(df_data.columns) != set(DB_SCHEMA.keys()):
+    # Check for valid columns, in the order of the schema
+    if tuple(df_data.columns) != DB_COLUMNS:
         return """Erreur: Les colonnes ne sont pas valides.
         Veuillez vérifier les colonnes suivantes: code, designation, dlc, quantite."""
 
@@ -85,18 +89,22 @@ def is_valid_data(df_data: pd.DataFrame) -> str:
         if df_data[k].dtype != t:
             return f"Erreur: La colonne {k} doit être de type {s}."
 
-    # Check for positive quantities
-    if not (df_data["quantite"] >= 0).all():
+    # Convert the data to an Arrow table once, the Arrow-backed columns are not copied
+    table = pa.Table.from_pandas(df_data, preserve_index=False)
+
+    # Check for missing values first, the null counts are stored with the columns and need no scan
+    if any(column.null_count for column in table.columns):
+        return "Erreur: Les données ne doivent pas contenir de valeurs manquantes."
+
+    # Check for positive quantities, with a single reduction over the column
+    min_quantity = pc.min(table["quantite"]).as_py()
+    if min_quantity is not None and min_quantity < 0:
         return "Erreur: La colonne 'quantite' doit être supérieure ou égale à zéro."
 
     # Check for unique article codes
-    if not df_data["code"].is_unique:
+    if pc.count_distinct(table["code"]).as_py() != table.num_rows:
         return "Erreur: Les codes d'articles doivent être uniques."
 
-    # Check for missing values
-    if df_data.isnull().values.any():
-        return "Erreur: Les données ne doivent pas contenir de valeurs manquantes."
-
     return ""
 
 
@@ -115,35 +123,49 @@ def is_valid_date(date: str) -> bool:
         True if the date is valid, False otherwise.
     """
     try:
-        pd.to_datetime(date, format=DATE_FORMAT_PD)
+        datetime.strptime(date, DATE_FORMAT_PD)
         return True
 
-    except Exception:
+    except ValueError:
         return False
 
 
-def typecast_data(df_data: pd.DataFrame) -> pd.DataFrame:
+def products_to_csv(products: pd.DataFrame) -> bytes:
     """
-    Typecast the data to the expected types.
+    Write the products to CSV with pyarrow, with the dates written as 'YYYY-MM-DD'. The header and
+    the values are written without quotes like 'DataFrame.to_csv' does, unless a value needs them.
 
     Parameters
     ----------
-    df_data : pd.DataFrame
-        The data to typecast.
+    products : pd.DataFrame
+        The products to write.
 
     Returns
     -------
-    pd.DataFrame
-        The typecasted data.
+    bytes
+        The CSV content.
     """
-    for k, (t, _) in DB_SCHEMA.items():
-        if t == "datetime64[ns]":
-            df_data[k] = pd.to_datetime(df_data[k], format=DATE_FORMAT_PD)
+    table = pa.Table.from_pandas(products, preserve_index=False)
+    dlc = pc.cast(table["dlc"], pa.date32(), safe=False)
+    table = table.set_column(table.schema.get_field_index("dlc"), "dlc", dlc)
+
+    # Write the header without quotes, the column names never need them
+    header = (",".join(table.column_names) + "\n").encode()
 
-        else:
-            df_data[k] = df_data[k].astype(t)
+    # Write the values without quotes. The 'needed' style of pyarrow quotes every string, so it is
+    # only used when a value contains a delimiter, a quote or a line break.
+    buffer = BytesIO()
 
-    return df_data
+    try:
+        options = pacsv.WriteOptions(include_header=False, quoting_style="none")
+        pacsv.write_csv(table, buffer, write_options=options)
+
+    except pa.ArrowInvalid:
+        buffer = BytesIO()
+        options = pacsv.WriteOptions(include_header=False, quoting_style="needed")
+        pacsv.write_csv(table, buffer, write_options=options)
+
+    return header + buffer.getvalue()
 
 
 def send_email(products: pd.DataFrame, sender: str, receiver: str, tokens: str) -> str:
@@ -180,12 +202,20 @@ def send_email(products: pd.DataFrame, sender: str, receiver: str, tokens: str)
         msg["To"] = receiver
         msg["Subject"] = f"Produits a expiration prochaine - {date}"
 
+        # Create the table of the email body, escaping the values
+        header = "".join(f"<th>{html.escape(str(k))}</th>" for k in products_body.columns)
+        rows = "".join(
+            "<tr>" + "".join(f"<td>{html.escape(str(v))}</td>" for v in row) + "</tr>"
+            for row in products_body.itertuples(index=False, name=None)
+        )
+        table = f'<table border="1"><thead><tr>{header}</tr></thead><tbody>{rows}</tbody></table>'
+
         # Create the email body
         body = f"""
         <p>Bonjour,</p>
         <p>Voici la liste des produits qui vont bientôt expirer:</p>
 
-        {products_body.to_html(index=False)}
+        {table}
 
         <p>Cordialement,</p>
         <p>Gestion de stock</p>
@@ -199,7 +229,7 @@ def send_email(products: pd.DataFrame, sender: str, receiver: str, tokens: str)
         # Create the attachment
         filename = f"products_{date}.csv"
         attachment = MIMEBase("application", "octet-stream")
-        attachment.set_payload(products.to_csv(index=False))
+        attachment.set_payload(products_to_csv(products))
         encoders.encode_base64(attachment)
         attachment.add_header("Content-Disposition", f"attachment; filename= {filename}")
         msg.attach(attachment)